@@ -11,11 +11,14 @@ MODEL_NAME = "model_name"
 
 BACKBONE = "backbone"
 DEEPLAB_OUTPUT_STRIDE = "deeplab_output_stride"
+GRADIENT_CHECKPOINTING = "gradient_checkpointing"
+COMPILE_MODEL = "compile_model"
 
 MODEL = "model"
 
 NN_INPUT_SIZE = "nn_input_shape"
 STATE_DICT_FILE_PATH = "state_dict_file_path"
+CHECKPOINT_INTERVAL = "checkpoint_interval"
 
 EPOCH = "epoch"
 STEP = "step"
@@ -26,7 +29,13 @@ CROPS_PER_IMAGE = "crops"
 CROP_SIZE_MIN = "crop_size_min"
 CROP_SIZE_MAX = "crop_size_max"
 
+NUM_WORKERS = "num_workers"
+DECODE_ON_DEVICE = "decode_on_device"
+
 USE_LR_SCHEDULER = "use_lr_scheduler"
+USE_MIXED_PRECISION = "use_mixed_precision"
+
+LOG_INTERVAL = "log_interval"
 
 CLASS_STATS_FILE_PATH = "class_stats_file_path"
 
@@ -9,7 +9,7 @@ import numpy as np
 
 from coral_reef.constants import strings as STR
 from coral_reef.constants import paths
-from coral_reef.ml.utils import cut_windows, calc_IOU
+from coral_reef.ml.utils import cut_windows, calc_iou_matrix
 
 import matplotlib.pyplot as plt
 
@@ -59,14 +59,8 @@ def _get_bad_prediction_rects(gt, pred, rect_size, density_thresh):
         new_rect = [*pts[index], pts[index][0] + rect_size, pts[index][1] + rect_size]
 
         # check if the new rect would overlap too much with an old one (which has a higher density)
-        much_overlap = False
-        for rect in out_rects:
-            if calc_IOU(rect, new_rect) > IOU_thresh:
-                much_overlap = True
-                break
-
         # if too much overlap go one with the next rect
-        if much_overlap:
+        if out_rects and np.any(calc_iou_matrix([new_rect], out_rects) > IOU_thresh):
             continue
 
         out_rects.append(new_rect)
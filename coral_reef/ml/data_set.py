@@ -6,6 +6,8 @@ import cv2
 import numpy as np
 from scipy.ndimage import zoom
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 from torch.utils.data import Dataset
 
 from coral_reef.constants import strings as STR
@@ -16,13 +18,86 @@ def load_image(filepath):
     return cv2.imread(filepath)[:, :, ::-1]
 
 
+def load_encoded_image(filepath):
+    """
+    Load the raw bytes of an (jpeg) image file without decoding it
+    :param filepath: path to the image
+    :return: 1-dimensional uint8 array
+    """
+    return np.fromfile(filepath, dtype=np.uint8)
+
+
+def get_exif_orientation(encoded_image):
+    """
+    Read the EXIF orientation tag of an encoded jpeg image without decoding it
+    :param encoded_image: 1-dimensional uint8 array containing the jpeg file
+    :return: orientation value (1 means the image is stored upright). 1 if the image has no orientation tag, None if
+    the data is not a complete jpeg file
+    """
+    # a jpeg file starts with the start of image and ends with the end of image marker
+    if encoded_image[:2].tobytes() != b"\xff\xd8" or encoded_image[-2:].tobytes() != b"\xff\xd9":
+        return None
+
+    # the EXIF segment is at the start of the file
+    data = encoded_image[:65536].tobytes()
+
+    i = 2
+    while i + 4 <= len(data) and data[i] == 0xFF:
+        marker = data[i + 1]
+        # stop at the start of the image data
+        if marker in (0xD9, 0xDA):
+            break
+
+        length = int.from_bytes(data[i + 2:i + 4], "big")
+
+        if marker == 0xE1 and data[i + 4:i + 10] == b"Exif\x00\x00":
+            tiff = data[i + 10:i + 2 + length]
+            byte_order = "little" if tiff[:2] == b"II" else "big"
+
+            # go through the entries of the first image file directory
+            ifd_offset = int.from_bytes(tiff[4:8], byte_order)
+            entry_count = int.from_bytes(tiff[ifd_offset:ifd_offset + 2], byte_order)
+            for j in range(entry_count):
+                entry = ifd_offset + 2 + 12 * j
+                if int.from_bytes(tiff[entry:entry + 2], byte_order) == 0x0112:
+                    return int.from_bytes(tiff[entry + 8:entry + 10], byte_order) or 1
+            return 1
+
+        i += 2 + length
+
+    return 1
+
+
+def device_decoding_available():
+    """
+    Check if the installed torchvision can decode jpeg images on the gpu
+    :return: True if torchvision.io.decode_jpeg is available
+    """
+    try:
+        from torchvision.io import decode_jpeg
+    except ImportError:
+        return False
+    return True
+
+
 class DictArrayDataSet(Dataset):
 
-    def __init__(self, image_base_dir, data, num_classes, transformation=None):
+    def __init__(self, image_base_dir, data, colour_mapping, transformation=None, decode_images=True):
+        """
+        :param image_base_dir: folder that the image and mask paths are relative to
+        :param data: list of dicts containing image and mask paths
+        :param colour_mapping: mapping from class name to colour
+        :param transformation: transformation that is applied to each sample
+        :param decode_images: if False, images are returned as encoded jpeg bytes so that they can be decoded on the gpu.
+        Images that need to be rotated according to their EXIF orientation are still decoded with OpenCV, since the gpu
+        decoder ignores the orientation and the images would not match their masks anymore
+        """
         self.image_base_dir = image_base_dir
         self.image_data = data
-        self.class_count = num_classes
+        self.colour_mapping = colour_mapping
+        self.class_count = len(colour_mapping.keys())
         self.transformation = transformation
+        self.decode_images = decode_images
 
     def __len__(self):
         return len(self.image_data)
@@ -33,7 +108,15 @@ class DictArrayDataSet(Dataset):
     def load_nn_input(self, index):
         item = self.image_data[index]
         file_path_image = os.path.join(self.image_base_dir, item[STR.IMAGE_NAME])
-        image = load_image(file_path_image)
+        if self.decode_images:
+            return load_image(file_path_image)
+
+        image = load_encoded_image(file_path_image)
+
+        # cv2.imread applies the EXIF orientation (and the masks were created with it), the gpu decoder does not.
+        # Files that are not (complete) jpegs can't be decoded on the gpu at all
+        if get_exif_orientation(image) != 1:
+            image = load_image(file_path_image)
 
         return image
 
@@ -42,7 +125,7 @@ class DictArrayDataSet(Dataset):
         file_path_mask = os.path.join(self.image_base_dir, item[STR.MASK_NAME])
         mask = load_image(file_path_mask)[:, :, 0]
 
-        class_id_mask = ml_utils.colour_mask_to_class_id_mask(mask)
+        class_id_mask = ml_utils.colour_mask_to_class_id_mask(mask, self.colour_mapping)
 
         return class_id_mask
 
@@ -202,6 +285,13 @@ class ToTensor:
 
         nn_target = sample.get(STR.NN_TARGET, None)
 
+        # encoded images are passed on as they are
+        if nn_input.ndim == 1:
+            sample[STR.NN_INPUT] = torch.from_numpy(nn_input)
+            if nn_target is not None:
+                sample[STR.NN_TARGET] = torch.from_numpy(np.expand_dims(nn_target, 0))
+            return sample
+
         if nn_input.ndim == 3:
             nn_input = np.expand_dims(nn_input, 0)
             nn_target = np.expand_dims(nn_target, 0) if nn_target is not None else None
@@ -245,3 +335,216 @@ def custom_collate(samples):
     out_batch_masks = torch.stack(out_batch_masks)
 
     return {STR.NN_INPUT: out_batch_images, STR.NN_TARGET: out_batch_masks}
+
+
+def list_collate(samples):
+    """
+    Collate function for samples that can not be stacked because their images differ in size. Keeps the tensors in lists
+    :param samples: List of sample objects
+    :return: Sample with lists of tensors
+    """
+    return {STR.NN_INPUT: [sample[STR.NN_INPUT] for sample in samples],
+            STR.NN_TARGET: [sample[STR.NN_TARGET] for sample in samples]}
+
+
+class BatchAugmentation(nn.Module):
+    """
+    Normalizes, randomly crops, resizes and flips a batch of images on the device the batch is stored on. Does the same
+    as Normalize, RandomCrop, Resize and Flip. All crops of an image are cropped and resized with a single grid_sample
+    call, flipping is done for the whole batch at once.
+    Expects samples as created by ToTensor and list_collate (and decoded by DataPrefetcher), i.e. lists of uint8 tensors
+    with shape (1, 3, H, W) and (1, H, W)
+    """
+
+    def __init__(self, size, crop_min_size=None, crop_max_size=None, crop_count=None, p_vertical=0.5,
+                 p_horizontal=0.5):
+        """
+        :param size: size that the (square) output images will have
+        :param crop_min_size: minimum size of the random crops
+        :param crop_max_size: maximum size of the random crops
+        :param crop_count: number of crops per image. If None, the images will not be cropped
+        :param p_vertical: probability of flipping an image vertically
+        :param p_horizontal: probability of flipping an image horizontally
+        """
+        super().__init__()
+        self.size = size
+        self.crop_min_size = crop_min_size
+        self.crop_max_size = crop_max_size
+        self.crop_count = crop_count
+        self.p_vertical = p_vertical
+        self.p_horizontal = p_horizontal
+
+    def forward(self, sample):
+        nn_inputs = []
+        nn_targets = []
+
+        for image, mask in zip(sample[STR.NN_INPUT], sample[STR.NN_TARGET]):
+            assert image.shape[-2:] == mask.shape[-2:], \
+                "image shape {} does not match mask shape {}".format(tuple(image.shape), tuple(mask.shape))
+
+            h, w = image.shape[-2:]
+            regions = self._regions(h, w)
+
+            # only the part of the image that is covered by the regions is converted to float
+            x0 = max(int(min(x for x, _, _, _ in regions)), 0)
+            y0 = max(int(min(y for _, y, _, _ in regions)), 0)
+            x1 = min(int(np.ceil(max(x + region_w for x, _, region_w, _ in regions))), w)
+            y1 = min(int(np.ceil(max(y + region_h for _, y, _, region_h in regions))), h)
+
+            image = image[..., y0:y1, x0:x1].float() / 255.0
+            # sampling needs a channel axis and float values
+            mask = mask[..., y0:y1, x0:x1].unsqueeze(1).float()
+
+            # crop and resize all regions of the image at once
+            grid = self._sampling_grid(regions, x0, y0, x1 - x0, y1 - y0, image.device)
+            count = len(regions)
+            nn_inputs.append(F.grid_sample(image.expand(count, -1, -1, -1), grid, mode="bilinear",
+                                           padding_mode="zeros", align_corners=False))
+            nn_targets.append(F.grid_sample(mask.expand(count, -1, -1, -1), grid, mode="nearest",
+                                            padding_mode="zeros", align_corners=False))
+
+        nn_input = torch.cat(nn_inputs)
+        nn_target = torch.cat(nn_targets)[:, 0].long()
+
+        nn_input, nn_target = self._flip(nn_input, nn_target)
+
+        return {STR.NN_INPUT: nn_input,
+                STR.NN_TARGET: nn_target}
+
+    def _regions(self, h, w):
+        """
+        Decide which regions of an image will be scaled to the output size
+        :param h: image height
+        :param w: image width
+        :return: list of regions (x, y, width, height)
+        """
+        if self.crop_count is None:
+            # like Resize, scale by the height. The region reaches over the right border (which is filled up with
+            # zeros) or cuts off the right side if the image is not square
+            scaled_w = int(round(w * self.size / h))
+            return [(0, 0, w * self.size / scaled_w, h)]
+
+        regions = []
+        for i in range(self.crop_count):
+            # decide crop size
+            size = np.random.randint(self.crop_min_size, self.crop_max_size)
+
+            # decide where to crop
+            x = np.random.randint(0, w - size - 1)
+            y = np.random.randint(0, h - size - 1)
+
+            regions.append((x, y, size, size))
+
+        return regions
+
+    def _sampling_grid(self, regions, offset_x, offset_y, w, h, device):
+        """
+        Create the grid that samples each region of a (w x h) image, which starts at (offset_x, offset_y) in the original
+        image, to the output size
+        :param regions: list of regions (x, y, width, height) in original image coordinates
+        :param offset_x: x coordinate of the sampled part of the image
+        :param offset_y: y coordinate of the sampled part of the image
+        :param w: width of the sampled part of the image
+        :param h: height of the sampled part of the image
+        :param device: device the grid will be created on
+        :return: grid as created by F.affine_grid
+        """
+        theta = np.zeros((len(regions), 2, 3), dtype=np.float32)
+        for i, (x, y, region_w, region_h) in enumerate(regions):
+            # map the normalised output coordinates [-1, 1] to the region in normalised input coordinates
+            theta[i, 0, 0] = region_w / w
+            theta[i, 0, 2] = (2 * (x - offset_x) + region_w) / w - 1
+            theta[i, 1, 1] = region_h / h
+            theta[i, 1, 2] = (2 * (y - offset_y) + region_h) / h - 1
+
+        theta = torch.from_numpy(theta).to(device)
+        return F.affine_grid(theta, size=[len(regions), 1, self.size, self.size], align_corners=False)
+
+    def _flip(self, nn_input, nn_target):
+        count = nn_input.shape[0]
+
+        flip_vertical = torch.rand(count, device=nn_input.device) < self.p_vertical
+        nn_input = torch.where(flip_vertical[:, None, None, None], nn_input.flip(2), nn_input)
+        nn_target = torch.where(flip_vertical[:, None, None], nn_target.flip(1), nn_target)
+
+        flip_horizontal = torch.rand(count, device=nn_input.device) < self.p_horizontal
+        nn_input = torch.where(flip_horizontal[:, None, None, None], nn_input.flip(3), nn_input)
+        nn_target = torch.where(flip_horizontal[:, None, None], nn_target.flip(2), nn_target)
+
+        return nn_input, nn_target
+
+
+class DataPrefetcher:
+    """
+    Iterates over a data loader and moves the batches to the given device. On the gpu, the next batch is copied on a
+    separate CUDA stream while the current batch is being processed. Encoded jpeg images are decoded on the device.
+    """
+
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device) if device.type == "cuda" else None
+
+        self.loader_iter = None
+        self.next_sample = None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        self.loader_iter = iter(self.data_loader)
+        self.preload()
+        return self
+
+    def __next__(self):
+        if self.next_sample is None:
+            raise StopIteration
+
+        if self.stream is not None:
+            # make sure the copy has finished before the batch is used and that its memory is not reused too early
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            for tensors in self.next_sample.values():
+                for tensor in (tensors if isinstance(tensors, list) else [tensors]):
+                    tensor.record_stream(current_stream)
+
+        sample = self.next_sample
+        self.preload()
+
+        return sample
+
+    def preload(self):
+        """
+        Fetch the next batch from the data loader and start copying it to the device
+        :return:
+        """
+        try:
+            sample = next(self.loader_iter)
+        except StopIteration:
+            self.next_sample = None
+            return
+
+        if self.stream is None:
+            self.next_sample = self._to_device(sample)
+        else:
+            with torch.cuda.stream(self.stream):
+                self.next_sample = self._to_device(sample)
+
+    def _to_device(self, sample):
+        # samples created by list_collate are augmented on the device and keep their dtype
+        if isinstance(sample[STR.NN_INPUT], list):
+            return {STR.NN_INPUT: [self._image_to_device(t) for t in sample[STR.NN_INPUT]],
+                    STR.NN_TARGET: [t.to(self.device, non_blocking=True) for t in sample[STR.NN_TARGET]]}
+
+        return {STR.NN_INPUT: sample[STR.NN_INPUT].to(self.device, non_blocking=True),
+                STR.NN_TARGET: sample[STR.NN_TARGET].to(self.device, dtype=torch.long, non_blocking=True)}
+
+    def _image_to_device(self, image):
+        if image.ndim == 1:
+            # only needed if images are decoded on the device, and not available in older torchvision versions
+            from torchvision.io import decode_jpeg
+
+            # add the batch axis that ToTensor would have added
+            return decode_jpeg(image, device=self.device).unsqueeze(0)
+
+        return image.to(self.device, non_blocking=True)
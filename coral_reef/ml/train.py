@@ -3,10 +3,13 @@ import json
 from pprint import pprint
 import sys
 import time
+import warnings
 
 import torch
-import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 import torch.optim as optim
 from torchvision import transforms
 from tensorboardX import SummaryWriter
@@ -19,8 +22,9 @@ from coral_reef.constants import strings as STR
 
 from coral_reef.visualisation import visualisation
 
-from coral_reef.ml.data_set import DictArrayDataSet, RandomCrop, Resize, custom_collate, ToTensor, Flip, Normalize
-from coral_reef.ml.utils import load_state_dict, Saver, calculate_class_weights
+from coral_reef.ml.data_set import DictArrayDataSet, Resize, custom_collate, list_collate, ToTensor, Normalize, \
+    BatchAugmentation, DataPrefetcher, device_decoding_available
+from coral_reef.ml.utils import load_state_dict, Saver, calculate_class_weights, enable_gradient_checkpointing
 
 
 sys.path.extend([paths.DEEPLAB_FOLDER_PATH, os.path.join(paths.DEEPLAB_FOLDER_PATH, "utils")])
@@ -47,6 +51,11 @@ class Trainer:
         self.data_valid = data_valid
         self.instructions = instructions
 
+        # when started with torchrun, each process trains on its own gpu. Only the first one writes logs and checkpoints
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.local_rank = int(os.environ.get("LOCAL_RANK", 0)) if self.distributed else 0
+        self.is_main_process = not self.distributed or dist.get_rank() == 0
+
         # specify model save dir
         self.model_name = instructions[STR.MODEL_NAME]
         # now = time.localtime()
@@ -60,11 +69,14 @@ class Trainer:
 
         # define saver and save instructions
         self.saver = Saver(folder_path=experiment_folder_path,
-                           instructions=instructions)
-        self.saver.save_instructions()
+                           instructions=instructions,
+                           save_every_n=instructions.get(STR.CHECKPOINT_INTERVAL, 1))
 
         # define Tensorboard Summary
-        self.writer = SummaryWriter(log_dir=experiment_folder_path)
+        self.writer = None
+        if self.is_main_process:
+            self.saver.save_instructions()
+            self.writer = SummaryWriter(log_dir=experiment_folder_path)
 
         nn_input_size = instructions[STR.NN_INPUT_SIZE]
         state_dict_file_path = instructions.get(STR.STATE_DICT_FILE_PATH, None)
@@ -79,50 +91,84 @@ class Trainer:
 
         print("{}applying random cropping".format("" if apply_random_cropping else "_NOT_ "))
 
-        t = [Normalize()]
-        if apply_random_cropping:
-            t.append(RandomCrop(
-                min_size=instructions.get(STR.CROP_SIZE_MIN, 400),
-                max_size=instructions.get(STR.CROP_SIZE_MAX, 1000),
-                crop_count=crops_per_image))
-        t += [Resize(nn_input_size),
-              Flip(p_vertical=0.2, p_horizontal=0.5),
-              ToTensor()]
+        # images are only read (and optionally decoded) in the data loader. Decoding, cropping, resizing and flipping
+        # is done batch-wise on the device
+        transformations_train = transforms.Compose([ToTensor()])
 
-        transformations_train = transforms.Compose(t)
+        self.augmentation = BatchAugmentation(size=nn_input_size,
+                                              crop_min_size=instructions.get(STR.CROP_SIZE_MIN, 400),
+                                              crop_max_size=instructions.get(STR.CROP_SIZE_MAX, 1000),
+                                              crop_count=crops_per_image if apply_random_cropping else None,
+                                              p_vertical=0.2,
+                                              p_horizontal=0.5)
 
         # define transformers for validation
         transformations_valid = transforms.Compose([Normalize(), Resize(nn_input_size), ToTensor()])
 
+        # decide whether the model will be compiled, which only pays off on the gpu
+        compile_model = instructions.get(STR.COMPILE_MODEL, torch.cuda.is_available())
+        if compile_model and not hasattr(torch, "compile"):
+            warnings.warn("torch.compile requires PyTorch 2.0 or newer, the model will not be compiled")
+            compile_model = False
+
+        # decode the jpegs on the gpu if the installed torchvision supports it
+        decode_on_device = instructions.get(STR.DECODE_ON_DEVICE, torch.cuda.is_available())
+        if decode_on_device and not device_decoding_available():
+            warnings.warn("Decoding images on the gpu requires torchvision 0.10 or newer, images will be decoded with "
+                          "OpenCV")
+            decode_on_device = False
+
         # set up data loaders
         dataset_train = DictArrayDataSet(image_base_dir=image_base_dir,
                                          data=data_train,
-                                         num_classes=len(self.colour_mapping.keys()),
-                                         transformation=transformations_train)
+                                         colour_mapping=self.colour_mapping,
+                                         transformation=transformations_train,
+                                         decode_images=not decode_on_device)
 
         # define batch sizes
         self.batch_size = instructions[STR.BATCH_SIZE]
 
-        if apply_random_cropping:
-            self.data_loader_train = DataLoader(dataset=dataset_train,
-                                                batch_size=instructions[STR.IMAGES_PER_BATCH],
-                                                shuffle=True,
-                                                collate_fn=custom_collate)
-        else:
-            self.data_loader_train = DataLoader(dataset=dataset_train,
-                                                batch_size=self.batch_size,
-                                                shuffle=True,
-                                                collate_fn=custom_collate)
+        # load and transform the images in worker processes, which are kept alive between epochs
+        # with distributed training, the cpu cores are shared between the processes
+        default_num_workers = (os.cpu_count() or 0) // (dist.get_world_size() if self.distributed else 1)
+        num_workers = instructions.get(STR.NUM_WORKERS, default_num_workers)
+        # page-locked batches can be copied to the gpu asynchronously
+        loader_params = {"pin_memory": torch.cuda.is_available(),
+                         "num_workers": num_workers}
+        if num_workers > 0:
+            loader_params.update({"persistent_workers": True,
+                                  "prefetch_factor": 4})
+
+        # with random cropping, each image in a batch is turned into several crops
+        batch_size_train = instructions[STR.IMAGES_PER_BATCH] if apply_random_cropping else self.batch_size
+
+        # in distributed training, each process gets its own part of the training data
+        self.sampler_train = DistributedSampler(dataset_train, shuffle=True) if self.distributed else None
+
+        self.data_loader_train = DataLoader(dataset=dataset_train,
+                                            batch_size=batch_size_train,
+                                            shuffle=self.sampler_train is None,
+                                            sampler=self.sampler_train,
+                                            collate_fn=list_collate,
+                                            # a smaller last batch would make the compiled model recompile
+                                            drop_last=compile_model,
+                                            **loader_params)
 
         dataset_valid = DictArrayDataSet(image_base_dir=image_base_dir,
                                          data=data_valid,
-                                         num_classes=len(self.colour_mapping.keys()),
+                                         colour_mapping=self.colour_mapping,
                                          transformation=transformations_valid)
 
+        # each process validates its own part of the validation data, the results are combined afterwards. The sampler
+        # pads the data so that every process gets the same number of images, which repeats up to world_size - 1 images
+        sampler_valid = DistributedSampler(dataset_valid, shuffle=False) if self.distributed else None
+
         self.data_loader_valid = DataLoader(dataset=dataset_valid,
                                             batch_size=self.batch_size,
                                             shuffle=False,
-                                            collate_fn=custom_collate)
+                                            sampler=sampler_valid,
+                                            collate_fn=custom_collate,
+                                            **loader_params)
 
         self.num_classes = dataset_train.num_classes()
 
@@ -138,18 +184,61 @@ class Trainer:
             print(state_dict_file_path)
             load_state_dict(self.model, state_dict_file_path)
 
+        # trade compute for memory by recomputing the backbone activations in the backward pass
+        if instructions.get(STR.GRADIENT_CHECKPOINTING, False):
+            if instructions.get(STR.BACKBONE, "resnet") != "resnet":
+                warnings.warn("Gradient checkpointing is only supported for the resnet backbone")
+            else:
+                print("using gradient checkpointing")
+                enable_gradient_checkpointing([self.model.backbone.layer1, self.model.backbone.layer2,
+                                               self.model.backbone.layer3, self.model.backbone.layer4])
+
         learning_rate = instructions.get(STR.LEARNING_RATE, 1e-5)
         train_params = [{'params': self.model.get_1x_lr_params(), 'lr': learning_rate},
                         {'params': self.model.get_10x_lr_params(), 'lr': learning_rate}]
 
         # choose gpu or cpu
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        if instructions.get(STR.MULTI_GPU, False):
-            if torch.cuda.device_count() > 1:
-                print("Using ", torch.cuda.device_count(), " GPUs!")
-                self.model = nn.DataParallel(self.model)
-
-        self.model.to(self.device)
+        if self.distributed:
+            self.device = torch.device("cuda", self.local_rank)
+            torch.cuda.set_device(self.device)
+        else:
+            self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+            if instructions.get(STR.MULTI_GPU, False):
+                warnings.warn("Multi gpu training requires starting the training with torchrun. Using a single gpu")
+
+        # the input size is fixed, so let cuDNN pick the fastest algorithms once and allow TF32 on Ampere gpus
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+        # cuDNN's tensor core convolutions work on channels last (NHWC) tensors
+        self.model = self.model.to(self.device, memory_format=torch.channels_last)
+
+        # the network used for the forward pass shares its parameters with self.model, which is still used for saving
+        # so that the state_dict keys don't change
+        self.network = self.model
+
+        # DDP reduces the gradients of each bucket while the backward pass of the remaining layers is still running.
+        # Gradients are sent as fp16 to halve the communication
+        if self.distributed:
+            from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+
+            if self.is_main_process:
+                print("Using {} GPUs!".format(dist.get_world_size()))
+            self.network = DistributedDataParallel(self.network,
+                                                   device_ids=[self.local_rank],
+                                                   gradient_as_bucket_view=True,
+                                                   static_graph=True)
+            self.network.register_comm_hook(state=None, hook=default_hooks.fp16_compress_hook)
+
+        # fuse the model's operations into fewer kernels. All training batches have the same shape, the smaller last
+        # validation batch (and switching to eval mode) makes the model recompile once
+        if compile_model:
+            self.network = torch.compile(self.network, mode="max-autotune", dynamic=False)
+
+        # mixed precision is only available on the gpu
+        self.use_mixed_precision = instructions.get(STR.USE_MIXED_PRECISION, True) and self.device.type == "cuda"
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_mixed_precision)
 
         # Define Optimizer
         self.optimizer = torch.optim.SGD(train_params,
@@ -181,50 +270,81 @@ class Trainer:
                                           iters_per_epoch=len(self.data_loader_train))
 
         # print information before training start
-        print("-" * 60)
-        print("instructions")
-        pprint(instructions)
-        model_parameters = sum([p.nelement() for p in self.model.parameters()])
-        print("Model parameters: {:.2E}".format(model_parameters))
+        if self.is_main_process:
+            print("-" * 60)
+            print("instructions")
+            pprint(instructions)
+            model_parameters = sum(p.numel() for p in self.model.parameters())
+            print("Model parameters: {:.2E}".format(model_parameters))
+
+        # number of steps between progress bar updates
+        self.log_interval = instructions.get(STR.LOG_INTERVAL, 20)
 
         self.best_prediction = 0.0
 
     def train(self, epoch):
-        self.model.train()
-        train_loss = 0.0
+        self.network.train()
+        if self.sampler_train is not None:
+            self.sampler_train.set_epoch(epoch)
+
+        # losses are kept on the device to avoid synchronising with it after every step
+        loss_sum = torch.zeros((), device=self.device)
+        step_losses = []
 
         # create a progress bar
-        pbar = tqdm(self.data_loader_train)
+        pbar = tqdm(DataPrefetcher(self.data_loader_train, self.device), disable=not self.is_main_process)
         num_batches_train = len(self.data_loader_train)
 
-        # go through each item in the training data
+        # go through each item in the training data. The prefetcher already moved it to the device
         for i, sample in enumerate(pbar):
+            sample = self.augmentation(sample)
+
             # set input and target
-            nn_input = sample[STR.NN_INPUT].to(self.device)
-            nn_target = sample[STR.NN_TARGET].to(self.device, dtype=torch.float)
+            nn_input = sample[STR.NN_INPUT].contiguous(memory_format=torch.channels_last)
+            nn_target = sample[STR.NN_TARGET]
 
             if self.scheduler:
                 self.scheduler(self.optimizer, i, epoch, self.best_prediction)
 
-            # run model
-            output = self.model(nn_input)
+            # drop the old gradients instead of filling them with zeros
+            self.optimizer.zero_grad(set_to_none=True)
+
+            with torch.cuda.amp.autocast(enabled=self.use_mixed_precision):
+                # run model
+                output = self.network(nn_input)
 
-            # calc losses
-            loss = self.criterion(output, nn_target)
+                # calc losses
+                loss = self.criterion(output, nn_target)
             # # save step losses
             # combined_loss_steps.append(float(loss))
             # regression_loss_steps.append(float(regression_loss))
             # classification_loss_steps.append(float(classification_loss))
 
-            train_loss += loss.item()
-            pbar.set_description('Train loss: %.3f' % (train_loss / (i + 1)))
-            self.writer.add_scalar('train/total_loss_iter', loss.item(), i + num_batches_train * epoch)
+            loss_sum += loss.detach()
+            step_losses.append(loss.detach())
+            if (i + 1) % self.log_interval == 0:
+                pbar.set_description('Train loss: %.3f' % (loss_sum.item() / (i + 1)))
 
             # calculate gradient and update model weights
-            loss.backward()
+            self.scaler.scale(loss).backward()
             # torch.nn.utils.clip_grad_norm_(model.parameters(), 0.1)
-            self.optimizer.step()
-            self.optimizer.zero_grad()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+
+        # add up the losses of all processes
+        if self.distributed:
+            dist.all_reduce(loss_sum)
+
+        train_loss = loss_sum.item()
+
+        if not self.is_main_process:
+            return
+
+        # write the step losses collected during the epoch
+        if step_losses:
+            step_losses = torch.stack(step_losses).cpu().numpy()
+            for i, step_loss in enumerate(step_losses):
+                self.writer.add_scalar('train/total_loss_iter', step_loss, i + num_batches_train * epoch)
 
         self.writer.add_scalar('train/total_loss_epoch', train_loss, epoch)
         print("[Epoch: {}, num images/crops: {}]".format(epoch, num_batches_train * self.batch_size))
@@ -233,35 +353,57 @@ class Trainer:
 
     def validation(self, epoch):
 
-        self.model.eval()
+        self.network.eval()
         self.evaluator.reset()
-        test_loss = 0.0
+        loss_sum = torch.zeros((), device=self.device)
+        confusion_matrix = torch.zeros(self.num_classes ** 2, dtype=torch.long, device=self.device)
 
-        pbar = tqdm(self.data_loader_valid, desc='\r')
+        pbar = tqdm(DataPrefetcher(self.data_loader_valid, self.device), desc='\r', disable=not self.is_main_process)
         num_batches_val = len(self.data_loader_valid)
 
         for i, sample in enumerate(pbar):
             # set input and target
-            nn_input = sample[STR.NN_INPUT].to(self.device)
-            nn_target = sample[STR.NN_TARGET].to(self.device, dtype=torch.float)
+            nn_input = sample[STR.NN_INPUT].contiguous(memory_format=torch.channels_last)
+            nn_target = sample[STR.NN_TARGET]
 
-            with torch.no_grad():
-                output = self.model(nn_input)
+            with torch.no_grad(), torch.cuda.amp.autocast(enabled=self.use_mixed_precision):
+                output = self.network(nn_input)
+                loss = self.criterion(output, nn_target)
+            loss_sum += loss
+            if (i + 1) % self.log_interval == 0:
+                pbar.set_description('Test loss: %.3f' % (loss_sum.item() / (i + 1)))
 
-            loss = self.criterion(output, nn_target)
-            test_loss += loss.item()
-            pbar.set_description('Test loss: %.3f' % (test_loss / (i + 1)))
-            pred = output.data.cpu().numpy()
-            pred = np.argmax(pred, axis=1)
-            nn_target = nn_target.cpu().numpy()
-            # Add batch sample into evaluator
-            self.evaluator.add_batch(nn_target, pred)
+            # add batch sample to the confusion matrix, which stays on the device until the end of the epoch
+            pred = output.argmax(dim=1)
+            valid = (nn_target >= 0) & (nn_target < self.num_classes)
+            confusion_matrix += torch.bincount(self.num_classes * nn_target[valid] + pred[valid],
+                                               minlength=self.num_classes ** 2)
+
+        # combine the results of all processes
+        if self.distributed:
+            dist.all_reduce(loss_sum)
+            dist.all_reduce(confusion_matrix)
+
+        test_loss = loss_sum.item()
+
+        # hand the accumulated confusion matrix to the evaluator
+        self.evaluator.confusion_matrix += confusion_matrix.view(self.num_classes, self.num_classes).cpu().numpy()
 
         # Fast test during the training
         Acc = self.evaluator.Pixel_Accuracy()
         Acc_class = self.evaluator.Pixel_Accuracy_Class()
         mIoU = self.evaluator.Mean_Intersection_over_Union()
         FWIoU = self.evaluator.Frequency_Weighted_Intersection_over_Union()
+
+        new_pred = mIoU
+        is_best = new_pred > self.best_prediction
+        if is_best:
+            self.best_prediction = new_pred
+
+        # every process has the combined results, so writing them once is enough
+        if not self.is_main_process:
+            return
+
         self.writer.add_scalar('val/total_loss_epoch', test_loss, epoch)
         self.writer.add_scalar('val/mIoU', mIoU, epoch)
         self.writer.add_scalar('val/Acc', Acc, epoch)
@@ -272,17 +414,22 @@ class Trainer:
         print("Acc:{:.2f}, Acc_class:{:.2f}, mIoU:{:.2f}, fwIoU: {:.2f}".format(Acc, Acc_class, mIoU, FWIoU))
         print("Loss: {:.2f}".format(test_loss))
 
-        new_pred = mIoU
-        is_best = new_pred > self.best_prediction
-        if is_best:
-            self.best_prediction = new_pred
         self.saver.save_checkpoint(self.model, is_best, epoch)
 
 
 def train(data_train, data_valid, image_base_dir, instructions):
+    # torchrun sets LOCAL_RANK for each of the processes it starts, e.g.
+    # torchrun --nproc_per_node=<number of gpus> <training script>
+    distributed = instructions.get(STR.MULTI_GPU, False) and "LOCAL_RANK" in os.environ
+    if distributed:
+        dist.init_process_group("nccl")
+
     trainer = Trainer(data_train, data_valid, image_base_dir, instructions)
 
     epochs = instructions[STR.EPOCHS]
     for epoch in range(1, epochs + 1):
         trainer.train(epoch)
         trainer.validation(epoch)
+
+    if distributed:
+        dist.destroy_process_group()
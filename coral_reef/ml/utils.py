@@ -1,27 +1,49 @@
 import warnings
 import os
-import shutil
 import json
 
 import numpy as np
 import torch
+from torch.utils.checkpoint import checkpoint
 from coral_reef.constants import mapping
 
 from tensorboardX import SummaryWriter
 
 
-def colour_mask_to_class_id_mask(colour_mask):
+def _colour_to_class_id_lut(colour_mapping):
     """
-    :param colour_mask:
-    :return:
+    Create a lookup table that maps each (uint8) colour value to its class id. Unknown colours map to 0
+    :param colour_mapping: mapping from class name to colour
+    :return: array of length 256
     """
-    colour_mapping = mapping.get_colour_mapping()
-    class_id_mask = np.zeros(colour_mask.shape[:2]).astype(np.uint8)
+    lut = np.zeros(256, dtype=np.uint8)
+    for i, k in enumerate(sorted(colour_mapping.keys())):
+        lut[colour_mapping[k]] = i
+    return lut
+
 
+def _class_id_to_colour_lut(colour_mapping):
+    """
+    Create a lookup table that maps each class id to its (uint8) colour value. Unknown class ids map to 0
+    :param colour_mapping: mapping from class name to colour
+    :return: array of length 256
+    """
+    lut = np.zeros(256, dtype=np.uint8)
     for i, k in enumerate(sorted(colour_mapping.keys())):
-        class_id_mask[colour_mask == colour_mapping[k]] = i
+        lut[i] = colour_mapping[k]
+    return lut
+
+
+def colour_mask_to_class_id_mask(colour_mask, colour_mapping=None):
+    """
+    :param colour_mask:
+    :param colour_mapping: mapping from class name to colour. Loaded from disk if None
+    :return:
+    """
+    colour_mapping = mapping.get_colour_mapping() if colour_mapping is None else colour_mapping
+    lut = _colour_to_class_id_lut(colour_mapping)
 
-    return class_id_mask
+    return lut[colour_mask]
 
 
 def class_id_mask_to_colour_mask(class_id_mask):
@@ -30,37 +52,62 @@ def class_id_mask_to_colour_mask(class_id_mask):
     :return:
     """
     colour_mapping = mapping.get_colour_mapping()
+    lut = _class_id_to_colour_lut(colour_mapping)
 
-    colour_mask = np.zeros(class_id_mask.shape[:2]).astype(np.uint8)
+    return lut[class_id_mask]
 
-    for i, k in enumerate(sorted(colour_mapping.keys())):
-        colour_mask[class_id_mask == i] = colour_mapping[k]
 
-    return colour_mask
+# class weights that have already been calculated, keyed by (class stats file path, class names, modifier)
+_class_weights_cache = {}
 
 
 def calculate_class_weights(class_stats_file_path, colour_mapping, modifier=1.01):
-    with open(class_stats_file_path, "r") as fp:
-        stats = json.load(fp)
+    class_names = tuple(sorted(colour_mapping.keys()))
+    cache_key = (class_stats_file_path, class_names, modifier)
 
-    shares = [stats[c]["share"] for c in sorted(colour_mapping.keys())]
-    shares = np.array(shares)
-    class_weights = 1 / np.log(modifier + shares)
-    return class_weights
+    if cache_key not in _class_weights_cache:
+        with open(class_stats_file_path, "r") as fp:
+            stats = json.load(fp)
+
+        shares = np.fromiter((stats[c]["share"] for c in class_names), dtype=np.float64, count=len(class_names))
+        _class_weights_cache[cache_key] = 1 / np.log(modifier + shares)
+
+    return _class_weights_cache[cache_key].copy()
 
 
 def load_state_dict(model, filepath):
-    pretrained_dict = torch.load(filepath, map_location=lambda storage, loc: storage)
+    pretrained_dict = torch.load(filepath, map_location="cpu")
     model_dict = model.state_dict()
 
-    # 1. filter out unnecessary keys and mismatching sizes
+    # filter out unnecessary keys and mismatching sizes
     pretrained_dict = {k: v for k, v in pretrained_dict.items() if
-                       (k in model_dict) and (model_dict[k].shape == pretrained_dict[k].shape)}
+                       (k in model_dict) and (model_dict[k].shape == v.shape)}
+
+    # load the remaining weights, all other weights keep their current values
+    model.load_state_dict(pretrained_dict, strict=False)
+
 
-    # 2. overwrite entries in the existing state dict
-    model_dict.update(pretrained_dict)
-    # 3. load the new state dict
-    model.load_state_dict(model_dict)
+def enable_gradient_checkpointing(modules):
+    """
+    Make the given modules recompute their activations during the backward pass instead of storing them. The modules
+    themselves are not wrapped, so their state_dict keys stay the same
+    :param modules: list of modules
+    :return:
+    """
+    for module in modules:
+        module.forward = _checkpointed(module.forward)
+
+
+def _checkpointed(forward):
+    def checkpointed_forward(*args):
+        # there is nothing to save if no gradients are calculated
+        if not torch.is_grad_enabled():
+            return forward(*args)
+        # note: the recomputation runs the BatchNorm layers in train mode again, so their running statistics are
+        # updated twice per step
+        return checkpoint(forward, *args, use_reentrant=False)
+
+    return checkpointed_forward
 
 
 def cut_windows(image, window_size, step_size=None):
@@ -75,24 +122,18 @@ def cut_windows(image, window_size, step_size=None):
     step_size = int(window_size / 2) if step_size is None else step_size
 
     h, w = image.shape[:2]
-    cuts = []
-    start_points = []
-
-    for x in range(0, w, step_size):
-        end_x = np.min([x + window_size, w])
-        start_x = end_x - window_size
 
-        for y in range(0, h, step_size):
-            end_y = np.min([y + window_size, h])
-            start_y = end_y - window_size
+    # windows that would reach over the border are shifted back inside the image. This creates duplicates at the
+    # border which are removed by np.unique
+    xs = np.unique(np.minimum(np.arange(0, w, step_size), w - window_size))
+    ys = np.unique(np.minimum(np.arange(0, h, step_size), h - window_size))
 
-            pt = [start_x, start_y]
-            # only add  if it hasn't been added before
-            if pt not in start_points:
-                cuts.append(image[start_y:end_y, start_x:end_x])
-                start_points.append([start_x, start_y])
+    # the grid is unique by construction; x is the outer and y the inner index
+    grid_x, grid_y = np.meshgrid(xs, ys, indexing="ij")
+    start_points = np.stack([grid_x.ravel(), grid_y.ravel()], axis=1).tolist()
 
-            # print("x: {}/ y:{} to x: {}/ y:{}".format(start_x, start_y, end_x, end_y))
+    # slicing creates views, so no image data is copied
+    cuts = [image[y:y + window_size, x:x + window_size] for x, y in start_points]
 
     return cuts, start_points
 
@@ -160,10 +201,10 @@ def calc_intersection(rect1, rect2):
     :param rect2: rectangle list
     :return: union area
     """
-    x1 = max([rect1[0], rect2[0]])
-    y1 = max([rect1[1], rect2[1]])
-    x2 = min([rect1[2], rect2[2]])
-    y2 = min([rect1[3], rect2[3]])
+    x1 = max(rect1[0], rect2[0])
+    y1 = max(rect1[1], rect2[1])
+    x2 = min(rect1[2], rect2[2])
+    y2 = min(rect1[3], rect2[3])
 
     if (x2 < x1) or (y2 < y1):
         return 0
@@ -191,17 +232,51 @@ def calc_IOU(rect1, rect2):
     return calc_intersection(rect1, rect2) / calc_union(rect1, rect2)
 
 
+def calc_iou_matrix(rects1, rects2):
+    """
+    Calculate intersection over union between every rectangle of rects1 and every rectangle of rects2
+    :param rects1: array of shape (N, 4) containing [x1, y1, x2, y2] rectangles
+    :param rects2: array of shape (M, 4) containing [x1, y1, x2, y2] rectangles
+    :return: IOU array of shape (N, M)
+    """
+    rects1 = np.asarray(rects1, dtype=np.float64).reshape(-1, 4)
+    rects2 = np.asarray(rects2, dtype=np.float64).reshape(-1, 4)
+
+    x1 = np.maximum(rects1[:, None, 0], rects2[None, :, 0])
+    y1 = np.maximum(rects1[:, None, 1], rects2[None, :, 1])
+    x2 = np.minimum(rects1[:, None, 2], rects2[None, :, 2])
+    y2 = np.minimum(rects1[:, None, 3], rects2[None, :, 3])
+
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+
+    area1 = (rects1[:, 2] - rects1[:, 0]) * (rects1[:, 3] - rects1[:, 1])
+    area2 = (rects2[:, 2] - rects2[:, 0]) * (rects2[:, 3] - rects2[:, 1])
+
+    return intersection / (area1[:, None] + area2[None, :] - intersection)
+
+
 class Saver(object):
 
-    def __init__(self, folder_path, instructions):
+    def __init__(self, folder_path, instructions, save_every_n=1):
+        if save_every_n < 1:
+            raise ValueError("save_every_n must be at least 1, got {}".format(save_every_n))
+
         self.instructions = instructions
         self.folder_path = folder_path
+        self.save_every_n = save_every_n
 
     def save_checkpoint(self, model, is_best, epoch):
-        file_path = os.path.join(self.folder_path, "checkpoint_epoch_{}.pt".format(epoch))
-        torch.save(model.state_dict(), file_path)
+        state_dict = model.state_dict()
+
+        if epoch % self.save_every_n == 0:
+            file_path = os.path.join(self.folder_path, "checkpoint_epoch_{}.pt".format(epoch))
+            torch.save(state_dict, file_path, _use_new_zipfile_serialization=True)
+
         if is_best:
-            shutil.copyfile(file_path, os.path.join(self.folder_path, 'model_best.pth'))
+            # write to a temporary file first so that an interrupted save does not destroy the previous best model
+            file_path = os.path.join(self.folder_path, 'model_best.pth')
+            torch.save(state_dict, file_path + ".tmp", _use_new_zipfile_serialization=True)
+            os.replace(file_path + ".tmp", file_path)
 
     def save_instructions(self):
         with open(os.path.join(self.folder_path, "instructions.json"), "w") as fp: